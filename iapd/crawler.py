@@ -1,46 +1,81 @@
+import codecs
 import hashlib
 import logging
+import os
 import random
 import re
-import subprocess
+import shutil
 import tempfile
+import threading
 import time
-from os.path import join
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from email.utils import formatdate
+from functools import lru_cache
+from os.path import getmtime, getsize, isfile, join
 
 import requests
-from bs4 import BeautifulSoup
-from functional import seq
-from requests import HTTPError
+from requests import HTTPError, RequestException
+from requests.adapters import HTTPAdapter
+from selectolax.lexbor import LexborHTMLParser
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
+from urllib3.util.retry import Retry
+
+
+class RequestThrottle(object):
+
+    def __init__(self, min_delay_time, max_delay_time):
+        self._min_delay_time = min_delay_time
+        self._max_delay_time = max_delay_time
+        self._next_available_time = 0
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    def __enter__(self):
+        with self._lock:
+            now = time.monotonic()
+            start_time = max(now, self._next_available_time)
+            self._next_available_time = start_time + self._delay_time()
+        sleep_time = start_time - now
+        if sleep_time > 0:
+            self._logger.debug('Delaying request for {}s.'.format(sleep_time))
+            time.sleep(sleep_time)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self._lock:
+            self._next_available_time = max(self._next_available_time, time.monotonic() + self._delay_time())
+
+    def _delay_time(self):
+        return random.uniform(self._min_delay_time, self._max_delay_time)
 
 
 class IAPDSession(requests.Session):
 
     def __init__(self, min_delay_time=1.5, max_delay_time=2.5, timeout=30):
         super().__init__()
-        self._min_delay_time = min_delay_time
-        self._max_delay_time = max_delay_time
+        self._throttle = RequestThrottle(min_delay_time=min_delay_time, max_delay_time=max_delay_time)
         self._timeout = timeout
-        self._last_request_time = 0
         self._logger = logging.getLogger(self.__class__.__name__)
-
-    def request(self, *args, **kwargs):
-        kwargs['timeout'] = kwargs.get('timeout', self._timeout)
-        self._delay_request_if_needed()
-        self._logger.debug('%s with params %s' % (' '.join(args), kwargs))
-        response = super().request(*args, **kwargs)
-        self._last_request_time = time.time()
-        response.raise_for_status()
+        retries = Retry(total=3, status_forcelist=(429, 502, 503, 504), backoff_factor=1.0, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=16, pool_block=False, max_retries=retries)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, *args, cancel_event=None, **kwargs):
+        kwargs.setdefault('timeout', self._timeout)
+        with self._throttle:
+            if cancel_event is not None and cancel_event.is_set():
+                raise IAPDError('Request cancelled: {}'.format(' '.join(args)))
+            self._logger.debug('%s with params %s' % (' '.join(args), kwargs))
+            response = super().request(*args, **kwargs)
+        try:
+            response.raise_for_status()
+        except HTTPError:
+            response.close()
+            raise
         return response
 
-    def _delay_request_if_needed(self):
-        delay_time = random.uniform(self._min_delay_time, self._max_delay_time)
-        if delay_time > 0 and self._last_request_time > 0:
-            process_time = time.time() - self._last_request_time
-            if process_time < delay_time:
-                sleep_time = delay_time - process_time
-                self._logger.debug('Delaying request for {}s.'.format(sleep_time))
-                time.sleep(sleep_time)
-
 
 class IAPDError(Exception):
     pass
@@ -52,6 +87,7 @@ class IAPD(object):
         'accept-encoding': 'gzip, deflate, br',
         'accept-language': 'en-US,en;q=0.9',
         'cache-control': 'max-age=0',
+        'connection': 'keep-alive',
         'referer': 'https://adviserinfo.sec.gov/IAPD/default.aspx',
         'upgrade-insecure-requests': '1',
         'user-agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/72.0.3626.109 '
@@ -73,13 +109,21 @@ class IAPD(object):
     COMPANY_NAME_ID = 'ctl00_cphMain_landing_lblActiveOrgName'
     DETAILED_REPORT_ID = 'ctl00_cphMain_btnGetReport'
 
-    SEARCH_RESULT_ID_PATTERN = re.compile(r'ctl00_cphMain_rptrSearchResult_ctl\d{2,}_uc(Firm|Indvl)Item_hlSummary')
-    CRD_PATTERN = re.compile(r'CRD# (\d+)')
-    SEC_PATTERN = re.compile(r'SEC# ([\d-]+)')
-    ADDRESS_ID_PATTERN = re.compile(r'ctl00_cphMain_rptrSearchResult_ctl\d{2,}_uc(Firm|Indvl)Item_divAddress')
-    TYPE_PATTERN = re.compile(r'ctl00_cphMain_rptrSearchResult_ctl\d{2,}_uc(Firm|Indvl)Item_div\w{2,4}$')
-    STATUS_PATTERN = re.compile(r'ctl00_cphMain_rptrSearchResult_ctl\d{2,}_uc(Firm|Indvl)Item_div\w{2,4}'
-                                r'(Inactive|NotLicensed)')
+    CARD_NUMBER_PATTERN = re.compile(r'CRD# (?P<crd>\d+)|SEC# (?P<sec>[\d-]+)')
+    META_CHARSET_PATTERN = re.compile(br'<meta[^>]+charset=["\']?([\w-]+)', re.IGNORECASE)
+
+    FORM_TOKENS_SELECTOR = ('input[name="__VIEWSTATE"], input[name="__VIEWSTATEGENERATOR"], '
+                            'input[name="__EVENTVALIDATION"]')
+    SEARCH_RESULT_SELECTOR = 'a.alinkborder'
+    RESULT_SPANS_SELECTOR = 'span.displaycrd, span.displayname, span.names'
+    ADDRESS_SELECTOR = 'div[id^="ctl00_cphMain_rptrSearchResult_"][id$="Item_divAddress"]'
+    TYPE_SELECTOR = ('div[id^="ctl00_cphMain_rptrSearchResult_ctl"][id*="_ucFirmItem_div"], '
+                     'div[id^="ctl00_cphMain_rptrSearchResult_ctl"][id*="_ucIndvlItem_div"]')
+    STATUS_SELECTOR = 'div[id$="Inactive"], div[id$="NotLicensed"]'
+    DOWNLOAD_HEADERS = {
+        'accept-encoding': 'identity'
+    }
+
     SCOPES = {
         'individual': 'rdoIndvl',
         'firm': 'rdoFirm'
@@ -89,63 +133,99 @@ class IAPD(object):
         self._session = IAPDSession(min_delay_time=min_delay_time, max_delay_time=max_delay_time)
         self._session.headers.update(self.HEADERS)
         self._data = {}
+        self._executor = ThreadPoolExecutor(max_workers=2)
         self._logger = logging.getLogger(self.__class__.__name__)
 
-    @staticmethod
-    def _get_data(soup, term, scope, zip_code, zip_code_range, at_firm):
-        view_state, view_state_generator, event_validation = map(
-            lambda param: soup.find('input', attrs={'name': param}).get('value'),
-            ['__VIEWSTATE', '__VIEWSTATEGENERATOR', '__EVENTVALIDATION'])
+    @classmethod
+    def _parse_html(cls, response):
+        encoding = cls._get_declared_encoding(response)
+        if encoding and encoding != 'utf-8':
+            return LexborHTMLParser(response.content.decode(encoding, errors='replace'))
+        return LexborHTMLParser(response.content)
+
+    @classmethod
+    def _get_declared_encoding(cls, response):
+        if 'charset' in response.headers.get('content-type', '').lower():
+            encoding = response.encoding
+        else:
+            match = cls.META_CHARSET_PATTERN.search(response.content[:1024])
+            encoding = match.group(1).decode('ascii') if match else None
+        try:
+            return codecs.lookup(encoding).name if encoding else None
+        except LookupError:
+            return None
+
+    @classmethod
+    def _get_form_tokens(cls, tree):
+        tokens = {element.attributes['name']: element.attributes.get('value')
+                  for element in tree.css(cls.FORM_TOKENS_SELECTOR)}
+        return tokens
 
-        data = {
+    @staticmethod
+    def _get_search_fields(term, scope, zip_code, zip_code_range, at_firm):
+        fields = {
             '__EVENTTARGET': 'ctl00$cphMain$sbox$searchBtn',
-            '__VIEWSTATE': view_state,
-            '__VIEWSTATEGENERATOR': view_state_generator,
-            '__EVENTVALIDATION': event_validation,
             'ctl00$cphMain$sbox$searchScope': scope,
             'ctl00$cphMain$sbox$txt{}'.format(scope[3:]): term,
             'ctl00$cphMain$sbox$ddlZipRange': zip_code_range,
             'ctl00$cphMain$sbox$txtZip': zip_code,
             'ctl00$cphMain$sbox$txtAtFirm': at_firm
         }
-        return data
+        return fields
 
-    def _initialize_search(self, term, scope, zip_code, zip_code_range, at_firm):
+    def _initialize_search(self, search_fields):
         response = self._session.get(self.DEFAULT_URL)
-        soup = BeautifulSoup(response.content, 'lxml')
-        data = self._get_data(soup=soup,
-                              term=term,
-                              scope=scope,
-                              zip_code=zip_code,
-                              zip_code_range=zip_code_range,
-                              at_firm=at_firm)
+        tree = self._parse_html(response)
+        data = dict(search_fields, **self._get_form_tokens(tree))
         self._session.post(self.DEFAULT_URL, data=data)
 
     def _get_adv_two_from_brochures_url(self, url):
         response = self._session.get(url)
-        soup = BeautifulSoup(response.content, 'lxml')
-        adv_two = (soup.find('a', attrs={'id': self.ADV_TWO_BROCHURE_ID}) or {}).get('href', "")
+        tree = self._parse_html(response)
+        adv_two = self._get_href(tree, self.ADV_TWO_BROCHURE_ID)
         return adv_two
 
     @staticmethod
-    def _md5(text):
-        return hashlib.md5(text.encode()).hexdigest()
+    def _get_href(tree, element_id, default=""):
+        element = tree.css_first('#' + element_id)
+        return element.attributes.get('href', default) if element else default
+
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def _hash_url(url):
+        return hashlib.blake2b(url.encode(), digest_size=16).hexdigest()
+
+    def _save_form(self, url, local_path, headers):
+        # Write to a side file first so an interrupted download never looks complete.
+        partial_path = local_path + '.part'
+        with self._session.get(url, allow_redirects=True, stream=True, headers=headers) as r:
+            if r.status_code == 304:
+                self._logger.debug('File not modified: {}'.format(local_path))
+                return local_path
+            r.raw.decode_content = True
+            try:
+                with open(partial_path, 'wb') as fp:
+                    shutil.copyfileobj(r.raw, fp, 1 << 16)
+            except Exception:
+                with suppress(FileNotFoundError):
+                    os.remove(partial_path)
+                raise
+        os.replace(partial_path, local_path)
+        return local_path
 
     def _download_form(self, url, output_dir=None):
         folder = output_dir or tempfile.mkdtemp()
-        local_path = join(folder, self._md5(url) + ".pdf")
-        self._logger.debug('Downloaded file: {}'.format(local_path))
+        local_path = join(folder, self._hash_url(url) + ".pdf")
+        headers = dict(self.DOWNLOAD_HEADERS)
+        if isfile(local_path) and getsize(local_path) > 0:
+            headers['if-modified-since'] = formatdate(getmtime(local_path), usegmt=True)
         try:
-            r = self._session.get(url, allow_redirects=True)
-            open(local_path, 'w').write(r.content)
-        except HTTPError as e:
+            self._save_form(url=url, local_path=local_path, headers=headers)
+        except (RequestException, Urllib3HTTPError) as e:
+            # Reading the raw stream surfaces urllib3's own errors rather than requests' wrappers.
             self._logger.exception(e)
-            if e.response.status_code == 502:
-                self._logger.debug('Trying to use command to download.')
-                command = "wget {} -O {}".format(url, local_path)
-                subprocess.call(command, shell=True)
-            else:
-                raise IAPDError('Download failed: {}'.format(url))
+            raise IAPDError('Download failed: {}'.format(url))
+        self._logger.debug('Downloaded file: {}'.format(local_path))
         return local_path
 
     def search(self, term, scope='firm', zip_code=None, zip_code_range='5', at_firm=None, iadp_only=False):
@@ -165,71 +245,92 @@ class IAPD(object):
         if scope not in ['firm', 'individual']:
             raise IAPDError('Invalid search scope, must be firm or individual.')
         scope = self.SCOPES[scope]
+        search_fields = self._get_search_fields(term=term,
+                                                scope=scope,
+                                                zip_code=zip_code,
+                                                zip_code_range=zip_code_range,
+                                                at_firm=at_firm)
         if not self._data:
-            self._initialize_search(term=term,
-                                    scope=scope,
-                                    zip_code=zip_code,
-                                    zip_code_range=zip_code_range,
-                                    at_firm=at_firm)
+            self._initialize_search(search_fields=search_fields)
+            self._data.update(search_fields)
             response = self._session.get(self.SEARCH_URL)
         else:
-            self._data.update(
-                {
-                    'ctl00$cphMain$sbox$txt{}'.format(scope[3:]): term,
-                    'ctl00$cphMain$sbox$searchScope': scope
-                }
-            )
+            self._data.update(search_fields)
             response = self._session.post(self.SEARCH_URL, data=self._data)
         next_page = True
         while next_page:
-            soup = BeautifulSoup(response.content, 'lxml')
-            self._data.update(self._get_data(soup=soup,
-                                             term=term,
-                                             scope=scope,
-                                             zip_code=zip_code,
-                                             zip_code_range=zip_code_range,
-                                             at_firm=at_firm))
-            next_page = soup.find('a', attrs={'id': self.NEXT_PAGE_ID})
-            yield self._parse_search(soup=soup,
-                                     iadp_only=iadp_only)
+            tree = self._parse_html(response)
+            self._data.update(self._get_form_tokens(tree))
+            next_page = tree.css_first('#' + self.NEXT_PAGE_ID)
             if next_page:
-                self._data.update({'__EVENTTARGET': self.NEXT_PAGE_EVENT})
-                response = self._session.post(self.SEARCH_URL, data=self._data)
+                cancel_next_page = threading.Event()
+                next_response = self._executor.submit(self._session.post, self.SEARCH_URL,
+                                                      data=dict(self._data, __EVENTTARGET=self.NEXT_PAGE_EVENT),
+                                                      cancel_event=cancel_next_page)
+            try:
+                yield [firm for firm in self._parse_search_iter(tree=tree)
+                       if not iadp_only or self._check_url(firm['url'])]
+            except GeneratorExit:
+                if next_page:
+                    cancel_next_page.set()
+                raise
+            if next_page:
+                response = next_response.result()
 
-    def _parse_search(self, soup, iadp_only):
-        results = soup.find_all('a', attrs={'class': 'alinkborder'})
-        firms = []
+    def _parse_search_iter(self, tree):
+        results = tree.css(self.SEARCH_RESULT_SELECTOR)
         for result in results:
-            url = result.get('href')
-
-            display_card = result.find('span', attrs={'class': 'displaycrd'}).text
-            crd_number = self.CRD_PATTERN.search(display_card)
-            sec_number = self.SEC_PATTERN.search(display_card)
-
-            alternate_names_element = result.find('span', attrs={'class': 'names'})
-            alternate_names = alternate_names_element.text.strip() if alternate_names_element else None
-
-            address_element = result.find('div', attrs={'id': self.ADDRESS_ID_PATTERN})
-            firm_type_elements = result.find_all('div', attrs={'id': self.TYPE_PATTERN})
-            firm_types = seq(firm_type_elements).map(lambda type_: dict(
-                name=type_.find(text=True, recursive=False).strip(),
-                status=0 if type_.find('div', attrs={'id': self.STATUS_PATTERN}) else 1
-            )).list()
-            firms.append(
+            url = result.attributes.get('href')
+
+            spans = self._get_spans_by_class(result)
+
+            display_card = spans['displaycrd'].text()
+            card_numbers = {}
+            for match in self.CARD_NUMBER_PATTERN.finditer(display_card):
+                card_numbers.setdefault(match.lastgroup, match.group(match.lastgroup))
+
+            alternate_names_element = spans.get('names')
+            alternate_names = alternate_names_element.text().strip() if alternate_names_element else None
+
+            address_element = result.css_first(self.ADDRESS_SELECTOR)
+            firm_type_elements = [element for element in
+                                  result.css(self.TYPE_SELECTOR)
+                                  if self._is_type_id(element.id)]
+            firm_types = [
                 dict(
-                    url=self.BASE_URL + url if url.startswith('/Firm') or url.startswith('/Individual') else url,
-                    name=result.find('span', attrs={'class': 'displayname'}).text,
-                    crd=crd_number.group(1) if crd_number else None,
-                    sec=sec_number.group(1) if sec_number else None,
-                    alternate_names=alternate_names,
-                    address=address_element.text.strip() if address_element else None,
-                    type=firm_types
+                    name=self._get_own_text(type_),
+                    status=0 if type_.css_first(self.STATUS_SELECTOR) else 1
                 )
+                for type_ in firm_type_elements
+            ]
+            yield dict(
+                url=self.BASE_URL + url if url.startswith('/Firm') or url.startswith('/Individual') else url,
+                name=spans['displayname'].text(),
+                crd=card_numbers.get('crd'),
+                sec=card_numbers.get('sec'),
+                alternate_names=alternate_names,
+                address=address_element.text().strip() if address_element else None,
+                type=firm_types
             )
-        if iadp_only:
-            return seq(firms).filter(lambda x: self._check_url(x['url'])).list()
-        else:
-            return firms
+
+    def _get_spans_by_class(self, result):
+        spans = {}
+        for span in result.css(self.RESULT_SPANS_SELECTOR):
+            for class_name in (span.attributes.get('class') or '').split():
+                spans.setdefault(class_name, span)
+        return spans
+
+    @staticmethod
+    def _get_own_text(element):
+        for child in element.iter(include_text=True):
+            if child.tag == '-text' and child.text(deep=False).strip():
+                return child.text(deep=False).strip()
+        return ''
+
+    @staticmethod
+    def _is_type_id(element_id):
+        suffix = element_id.rpartition('Item_div')[2]
+        return 2 <= len(suffix) <= 4 and suffix.isalnum()
 
     @staticmethod
     def _check_params(crd, url, base_url):
@@ -262,25 +363,29 @@ class IAPD(object):
                                  base_url=self.FIRM_URL)
 
         response = self._session.get(url)
-        soup = BeautifulSoup(response.content, 'lxml')
+        tree = self._parse_html(response)
 
         adv_one_href, part_2_brochures_href = map(
-            lambda x: (soup.find('a', {'id': x}) or {}).get('href', ""), [self.ADV_ONE_HREF_ID, self.ADV_TWO_HREF_ID])
-
-        if part_2_brochures_href.startswith(self.ADV_TWO_BROCHURE_BASE_URL):
-            part_2_brochures_href = self._get_adv_two_from_brochures_url(self.BASE_URL + part_2_brochures_href)
+            lambda x: self._get_href(tree, x), [self.ADV_ONE_HREF_ID, self.ADV_TWO_HREF_ID])
 
-        adv_form, part_2_brochures = map(
-            lambda href: self.BASE_URL + href if href else None, [adv_one_href, part_2_brochures_href])
+        adv_form = self.BASE_URL + adv_one_href if adv_one_href else None
+        adv_form_future = self._executor.submit(self._download_form, url=adv_form,
+                                                output_dir=output_dir) if download else None
+        try:
+            if part_2_brochures_href.startswith(self.ADV_TWO_BROCHURE_BASE_URL):
+                part_2_brochures_href = self._get_adv_two_from_brochures_url(self.BASE_URL + part_2_brochures_href)
+            part_2_brochures = self.BASE_URL + part_2_brochures_href if part_2_brochures_href else None
 
-        if download:
-            adv_form_local_path = self._download_form(url=adv_form,
-                                                      output_dir=output_dir)
             part_2_brochures_local_path = self._download_form(url=part_2_brochures,
-                                                              output_dir=output_dir)
-        else:
-            adv_form_local_path = None
-            part_2_brochures_local_path = None
+                                                              output_dir=output_dir) if download else None
+        except Exception:
+            if adv_form_future is not None and not adv_form_future.cancel():
+                adv_form_error = adv_form_future.exception()
+                if adv_form_error is not None:
+                    self._logger.error('ADV form download failed: {}'.format(adv_form), exc_info=adv_form_error)
+            raise
+
+        adv_form_local_path = adv_form_future.result() if download else None
 
         return dict(
             adv_form_url=adv_form,
@@ -305,8 +410,8 @@ class IAPD(object):
                                  url=url,
                                  base_url=self.INDIVIDUAL_URL)
         response = self._session.get(url)
-        soup = BeautifulSoup(response.content, 'lxml')
-        detailed_report_url = (soup.find('a', attrs={'id': self.DETAILED_REPORT_ID}) or {}).get('href')
+        tree = self._parse_html(response)
+        detailed_report_url = self._get_href(tree, self.DETAILED_REPORT_ID, default=None)
         detailed_report_local_path = self._download_form(url=detailed_report_url,
                                                          output_dir=output_dir) if download else None
         return dict(
@@ -1,4 +1,5 @@
 import logging
+import random
 import time
 from functools import wraps
 
@@ -8,6 +9,8 @@ logger = logging.getLogger('Utils')
 
 
 def crawler_retry(max_retries=3, delay=5, back_off=1, default_value=None, retry_codes=(429, 503)):
+    retry_codes = frozenset(retry_codes)
+
     def wrapper(func):
         @wraps(func)
         def retry_func(*args, **kwargs):
@@ -21,12 +24,12 @@ def crawler_retry(max_retries=3, delay=5, back_off=1, default_value=None, retry_
                     if count > max_retries:
                         logger.debug('Max retries exceeded.')
                         break
-                    if hasattr(e.response, 'status_code'):
-                        if e.response.status_code in retry_codes:
-                            logger.debug("Error: {}, retrying in {} seconds.".format(e, delay_time))
-                            time.sleep(delay_time)
-                            delay_time *= back_off
-                            continue
+                    if getattr(e.response, 'status_code', None) in retry_codes:
+                        sleep_time = random.uniform(delay_time * 0.5, delay_time * 1.5)
+                        logger.debug("Error: {}, retrying in {} seconds.".format(e, sleep_time))
+                        time.sleep(sleep_time)
+                        delay_time *= back_off
+                        continue
                     logger.exception(e)
                     break
                 except Exception as e: